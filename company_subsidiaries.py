@@ -1,130 +1,799 @@
+import os
+import json
 import time
+import queue
+import atexit
+import logging
+import asyncio
+import shutil
+import sqlite3
+import tempfile
 import threading
-from typing import Dict, List, Set
+import subprocess
+from collections import OrderedDict
+from contextvars import ContextVar
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, NamedTuple, Optional
 from urllib.parse import quote_plus
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from playwright.sync_api import sync_playwright
+import httpx
+from selectolax.parser import HTMLParser
+from playwright.async_api import async_playwright
+
+try:
+    import uvloop  # optional, faster event loop on Linux/macOS
+except ImportError:
+    uvloop = None
+
+# Status messages go through a queue and are written by a single listener thread,
+# so concurrent searches never contend on stdout
+logger = logging.getLogger(__name__)
+
+def _configure_logging() -> "ContextVar[Optional[str]]":
+    """
+    Install the queue handler, listener thread and run-id filter on ``logger`` once per
+    process. The logger outlives re-imports of this module (Streamlit reloads changed
+    modules), so the setup is stored on it and reused instead of installed again.
+    Returns the ContextVar holding the id of the crawl a record belongs to.
+    """
+    run_id = getattr(logger, "_subsidiary_run_id", None)
+    if run_id is not None:
+        return run_id
+
+    run_id = ContextVar("run_id", default=None)
+
+    def tag_run_id(record):
+        record.run_id = run_id.get()
+        return True
+
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addFilter(tag_run_id)
+    log_queue: queue.Queue = queue.Queue()
+    logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    atexit.register(listener.stop)
+    logger._subsidiary_run_id = run_id
+    return run_id
+
+# Id of the crawl a record belongs to, so per-run handlers can ignore other runs' records.
+# Tasks and to_thread calls copy the context, so everything a crawl logs carries its id.
+_run_id = _configure_logging()
+
+USER_AGENT = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+              "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
+
+# Rotated across pooled browser contexts so they do not all share one fingerprint
+USER_AGENTS = [
+    USER_AGENT,
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36 Edg/119.0.0.0",
+]
+
+GOOGLE_HOME_URL = "https://www.google.com/"
+SEARCH_URL_TMPL = GOOGLE_HOME_URL + "search?q={q}"
+VIEWPORT = {"width": 1366, "height": 768}
+
+# Markers of pages Google serves instead of results (consent wall, captcha, JS check)
+BLOCKED_MARKERS = ("consent.google.com", "/sorry/", "captcha-form", "/httpservice/retry/enablejs")
+
+# Chromium flags shared by launched browsers and the CDP-shared browser process
+BROWSER_ARGS = [
+    "--no-sandbox",
+    "--disable-setuid-sandbox",
+    "--disable-blink-features=AutomationControlled",
+    "--disable-dev-shm-usage",
+    "--disable-gpu"
+]
+
+# Optional CDP endpoint of an already running Chromium to connect to instead of launching one
+CDP_ENDPOINT = os.environ.get("PLAYWRIGHT_CDP_ENDPOINT")
+
+# Most companies combined into one OR query before Google's query-length limits bite
+MAX_BATCH_SIZE = 8
+
+# Result cache: in-process LRU in front of an on-disk SQLite store
+CACHE_DB_PATH = os.environ.get("SUBSIDIARY_CACHE_PATH", "subsidiary_cache.sqlite3")
+CACHE_TTL_SECONDS = float(os.environ.get("SUBSIDIARY_CACHE_TTL", 7 * 24 * 3600))
+MEMORY_CACHE_SIZE = 4096
+
+def run_async(coro):
+    """Run a coroutine to completion like ``asyncio.run``, on uvloop when it is installed."""
+    if uvloop is not None:
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            return runner.run(coro)
+    return asyncio.run(coro)
 
 # ---------------------------------
-# Playwright Utilities
+# Result Cache
+# ---------------------------------
+# Shared by every run in the process (Streamlit sessions are threads), so both the LRU and
+# the single SQLite connection are guarded by locks. Disk access runs off the event loop.
+_memory_cache: "OrderedDict[str, List[str]]" = OrderedDict()
+_memory_lock = threading.Lock()
+_cache_db: Optional[sqlite3.Connection] = None
+_cache_db_lock = threading.Lock()
+
+def _normalize(company_name: str) -> str:
+    return company_name.lower().strip()
+
+def _remember(key: str, names: List[str]):
+    with _memory_lock:
+        _memory_cache[key] = names
+        _memory_cache.move_to_end(key)
+        if len(_memory_cache) > MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+def _recall(key: str) -> Optional[List[str]]:
+    with _memory_lock:
+        names = _memory_cache.get(key)
+        if names is None:
+            return None
+        _memory_cache.move_to_end(key)
+        return list(names)
+
+def _close_cache_db():
+    global _cache_db
+    with _cache_db_lock:
+        if _cache_db is not None:
+            _cache_db.close()
+            _cache_db = None
+
+def _get_cache_db() -> sqlite3.Connection:
+    """Open the process-wide cache connection on first use. Call with ``_cache_db_lock`` held."""
+    global _cache_db
+    if _cache_db is None:
+        conn = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS subsidiaries ("
+            "name TEXT PRIMARY KEY, fetched_at REAL NOT NULL, results TEXT NOT NULL)"
+        )
+        conn.commit()
+        _cache_db = conn
+        atexit.register(_close_cache_db)
+    return _cache_db
+
+def _read_cache_db(key: str) -> Optional[List[str]]:
+    with _cache_db_lock:
+        row = _get_cache_db().execute(
+            "SELECT results FROM subsidiaries WHERE name = ? AND fetched_at >= ?",
+            (key, time.time() - CACHE_TTL_SECONDS)
+        ).fetchone()
+    return None if row is None else json.loads(row[0])
+
+def _write_cache_db(key: str, names: List[str]):
+    with _cache_db_lock:
+        conn = _get_cache_db()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO subsidiaries (name, fetched_at, results) VALUES (?, ?, ?)",
+                (key, time.time(), json.dumps(names))
+            )
+
+async def get_cached_subsidiaries(company_name: str) -> Optional[List[str]]:
+    """Return cached search results for a company, or None on a miss / expired entry."""
+    key = _normalize(company_name)
+    names = _recall(key)
+    if names is not None:
+        return names
+
+    try:
+        names = await asyncio.to_thread(_read_cache_db, key)
+    except sqlite3.Error as e:
+        logger.warning("Cache read failed for %s: %s", company_name, e)
+        return None
+    if names is None:
+        return None
+
+    _remember(key, names)
+    return list(names)
+
+async def cache_subsidiaries(company_name: str, names: List[str]):
+    """Store successful search results in memory and on disk."""
+    key = _normalize(company_name)
+    _remember(key, list(names))
+    try:
+        await asyncio.to_thread(_write_cache_db, key, list(names))
+    except sqlite3.Error as e:
+        logger.warning("Cache write failed for %s: %s", company_name, e)
+
+# ---------------------------------
+# HTTP Utilities
 # ---------------------------------
-def create_browser_context(playwright):
-    """Create a new browser context with stealth-like settings."""
-    browser = playwright.chromium.launch(headless=True, args=[
-        "--no-sandbox",
-        "--disable-setuid-sandbox",
-        "--disable-blink-features=AutomationControlled",
-        "--disable-dev-shm-usage",
-        "--disable-gpu"
-    ])
-    context = browser.new_context(
-        user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-                   "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-        viewport={"width": 1366, "height": 768}
+def create_http_client(max_workers: int = 2) -> httpx.AsyncClient:
+    """
+    Create the keep-alive HTTP/2 client shared by all searches of a run. Idle connections
+    are kept for a minute so the TLS session to Google is reused between searches.
+    """
+    return httpx.AsyncClient(
+        http2=True,
+        headers={"User-Agent": USER_AGENT, "Accept-Language": "en-US,en;q=0.9"},
+        timeout=30,
+        follow_redirects=True,
+        limits=httpx.Limits(max_keepalive_connections=max_workers, keepalive_expiry=60)
     )
-    return browser, context
 
-def get_subsidiaries_single_search(company_name: str) -> List[str]:
-    """Search Google for subsidiaries using Playwright."""
-    query = quote_plus(f"{company_name} Subsidiary")
-    url = f"https://www.google.com/search?q={query}"
+def _is_blocked(response: httpx.Response) -> bool:
+    """Return True when Google answered with an interstitial instead of a SERP."""
+    if response.status_code == 429:
+        return True
+    url = str(response.url)
+    return any(marker in url or marker in response.text for marker in BLOCKED_MARKERS)
+
+def _search_url(query: str) -> str:
+    return SEARCH_URL_TMPL.format(q=quote_plus(query))
 
-    with sync_playwright() as p:
-        browser, context = create_browser_context(p)
-        page = context.new_page()
+def _dedupe_names(values) -> List[str]:
+    """Strip entity names and drop blanks and repeats, keeping first-seen order."""
+    seen = set()
+    names = []
+    for val in values:
+        val = (val or "").strip()
+        if val and val not in seen:
+            seen.add(val)
+            names.append(val)
+    return names
+
+def _parse_entity_names(html: str) -> List[str]:
+    """Extract the ``data-entityname`` values from server-rendered SERP HTML."""
+    return _dedupe_names(
+        node.attributes.get("data-entityname") for node in HTMLParser(html).css("a[data-entityname]")
+    )
+
+# ---------------------------------
+# Playwright Utilities
+# ---------------------------------
+# Installed in every context so each search only needs ``page.evaluate("__extract()")``;
+# same result as _dedupe_names, computed in the page so only the final list crosses the pipe
+EXTRACT_INIT_SCRIPT = (
+    "window.__extract = () => [...new Set([...document.querySelectorAll('a[data-entityname]')]"
+    ".map(e => (e.getAttribute('data-entityname') || '').trim()).filter(Boolean))]"
+)
+
+# Resource types that never contribute to the a[data-entityname] extraction
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media", "stylesheet"}
+
+async def _block_heavy_resources(route):
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        await route.abort()
+    else:
+        await route.continue_()
+
+async def launch_browser(playwright, cdp_endpoint: Optional[str] = None):
+    """
+    Launch a headless Chromium with stealth-like settings, or connect to the shared
+    Chromium at ``cdp_endpoint`` when one is given. If that connection fails (e.g. the
+    shared browser crashed), a local browser is launched instead.
+    """
+    if cdp_endpoint:
         try:
-            page.goto(url, timeout=30000)
-            page.wait_for_selector("#search", timeout=10000)
+            return await playwright.chromium.connect_over_cdp(cdp_endpoint)
+        except Exception as e:
+            logger.warning("Could not connect to shared Chromium at %s, launching a local browser: %s",
+                           cdp_endpoint, e)
+    return await playwright.chromium.launch(headless=True, args=BROWSER_ARGS)
+
+# Chromium process started by start_shared_chromium (and the profile dir created for it),
+# terminated and removed at interpreter exit
+_shared_chromium: Optional[subprocess.Popen] = None
+_shared_chromium_dir: Optional[str] = None
+_shared_chromium_lock = threading.Lock()
+
+def stop_shared_chromium():
+    """Terminate and reap the Chromium started by ``start_shared_chromium``, if any."""
+    global _shared_chromium, _shared_chromium_dir
+    with _shared_chromium_lock:
+        process, _shared_chromium = _shared_chromium, None
+        profile_dir, _shared_chromium_dir = _shared_chromium_dir, None
+    if process is not None and process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+    if profile_dir is not None:
+        shutil.rmtree(profile_dir, ignore_errors=True)
+
+atexit.register(stop_shared_chromium)
+
+def cdp_endpoint_alive(endpoint: str, timeout: float = 2.0) -> bool:
+    """Return True when a Chromium is answering CDP requests at ``endpoint``."""
+    try:
+        return httpx.get(f"{endpoint}/json/version", timeout=timeout).status_code == 200
+    except httpx.HTTPError:
+        return False
+
+def _read_devtools_port(user_data_dir: str) -> Optional[int]:
+    """Read the port Chromium picked for ``--remote-debugging-port=0``, once it has written it."""
+    try:
+        with open(os.path.join(user_data_dir, "DevToolsActivePort"), encoding="utf-8") as f:
+            first_line = f.readline().strip()
+    except OSError:
+        return None
+    return int(first_line) if first_line.isdigit() else None
+
+async def start_shared_chromium(user_data_dir: Optional[str] = None,
+                                startup_timeout: float = 15.0) -> str:
+    """
+    Boot one headless Chromium with remote debugging enabled so several app workers
+    can share it over CDP. Returns the endpoint to pass as ``cdp_endpoint``.
+    Chromium picks a free port itself, so another browser already listening on the
+    usual 9222 can never be mistaken for this one. Without ``user_data_dir`` a private
+    temporary profile is used. A previously started shared Chromium is stopped first.
+    """
+    global _shared_chromium, _shared_chromium_dir
+    async with async_playwright() as p:
+        executable = p.chromium.executable_path
+
+    stop_shared_chromium()
+    created_dir = user_data_dir is None
+    if created_dir:
+        user_data_dir = tempfile.mkdtemp(prefix="pw-shared-")
+    else:
+        # A stale port file from an earlier browser would point at the wrong process
+        try:
+            os.remove(os.path.join(user_data_dir, "DevToolsActivePort"))
+        except FileNotFoundError:
+            pass
+
+    process = subprocess.Popen(
+        [executable, "--headless=new", "--remote-debugging-port=0",
+         f"--user-data-dir={user_data_dir}", *BROWSER_ARGS],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    with _shared_chromium_lock:
+        _shared_chromium = process
+        _shared_chromium_dir = user_data_dir if created_dir else None
+
+    deadline = time.monotonic() + startup_timeout
+    async with httpx.AsyncClient(timeout=2) as client:
+        while True:
+            port = _read_devtools_port(user_data_dir)
+            if port is not None:
+                endpoint = f"http://127.0.0.1:{port}"
+                try:
+                    response = await client.get(f"{endpoint}/json/version")
+                    if response.status_code == 200 and process.poll() is None:
+                        return endpoint
+                except httpx.HTTPError:
+                    pass
+            if process.poll() is not None or time.monotonic() > deadline:
+                stop_shared_chromium()
+                raise RuntimeError("Shared Chromium did not expose a CDP endpoint")
+            await asyncio.sleep(0.2)
+
+async def create_browser_context(browser, user_agent: str = USER_AGENT):
+    """Create a new isolated context on an already running browser."""
+    context = await browser.new_context(
+        user_agent=user_agent,
+        viewport=VIEWPORT
+    )
+    await context.add_init_script(EXTRACT_INIT_SCRIPT)
+    return context
+
+class BrowserFallback:
+    """
+    Shared Playwright browser that is only launched (or connected to over CDP)
+    the first time it is needed, with a pool of up to ``size`` reusable pages,
+    each in its own context.
+    """
+
+    def __init__(self, cdp_endpoint: Optional[str] = None, size: int = 1):
+        self._cdp_endpoint = cdp_endpoint
+        self._size = max(1, size)
+        self._playwright = None
+        self._browser = None
+        self._launch_error: Optional[Exception] = None
+        self._lock = asyncio.Lock()
+        self._contexts = []
+        self._created = 0
+        self._idle: asyncio.Queue = asyncio.Queue()
 
-            elems = page.query_selector_all("a[data-entityname]")
-            names = []
-            for e in elems:
-                val = e.get_attribute("data-entityname")
-                if val and val.strip():
-                    names.append(val.strip())
+    async def get(self):
+        async with self._lock:
+            # A failed launch is not retried within the run; every later fallback fails fast
+            if self._launch_error is not None:
+                raise RuntimeError(f"Playwright browser unavailable: {self._launch_error}")
+            if self._browser is None:
+                playwright = await async_playwright().start()
+                try:
+                    self._browser = await launch_browser(playwright, self._cdp_endpoint)
+                except Exception as e:
+                    self._launch_error = e
+                    await playwright.stop()
+                    raise
+                self._playwright = playwright
+        return self._browser
 
-            return list(dict.fromkeys(names))  # dedupe
+    async def _new_page(self):
+        browser = await self.get()
+        context = await create_browser_context(browser, USER_AGENTS[len(self._contexts) % len(USER_AGENTS)])
+        self._contexts.append(context)
+        page = await context.new_page()
+        await page.route("**/*", _block_heavy_resources)
+        # Open the connection to Google up front so the first search reuses a warm session
+        try:
+            await page.goto(GOOGLE_HOME_URL, wait_until="domcontentloaded", timeout=15000)
         except Exception as e:
-            print(f"Error searching for {company_name}: {str(e)}")
-            return []
+            logger.warning("Warm-up navigation failed: %s", e)
+        return page
+
+    @asynccontextmanager
+    async def page(self):
+        """Check a page out of the pool, creating one while the pool is below ``size``."""
+        if self._idle.empty() and self._created < self._size:
+            self._created += 1
+            try:
+                page = await self._new_page()
+            except Exception:
+                self._created -= 1
+                raise
+        else:
+            page = await self._idle.get()
+        try:
+            yield page
         finally:
-            context.close()
-            browser.close()
+            if page.is_closed():
+                # Replace crashed pages so coroutines waiting on the pool are not starved
+                try:
+                    page = await self._new_page()
+                except Exception:
+                    self._created -= 1
+                    page = None
+            if page is not None:
+                self._idle.put_nowait(page)
+
+    async def close(self):
+        for context in self._contexts:
+            try:
+                await context.close()
+            except Exception:
+                pass
+        # For a CDP connection this only disconnects; the shared Chromium keeps running
+        if self._browser is not None:
+            await self._browser.close()
+        if self._playwright is not None:
+            await self._playwright.stop()
+        self._browser = self._playwright = None
+        self._contexts = []
+
+async def _search_with_page(page, company_name: str) -> List[str]:
+    """Search Google for subsidiaries on a pooled Playwright page."""
+    url = _search_url(company_name + " Subsidiary")
+
+    await page.goto(url, wait_until="domcontentloaded", timeout=30000)
+    await page.wait_for_selector("a[data-entityname], #search", state="attached", timeout=10000)
+
+    # One round-trip to the browser returns the already stripped and deduped names
+    return await page.evaluate("__extract()")
+
+async def _search_with_http(client: httpx.AsyncClient, company_name: str) -> Optional[List[str]]:
+    """Search Google over plain HTTP. Returns None when the response is an interstitial."""
+    url = _search_url(company_name + " Subsidiary")
+
+    response = await client.get(url)
+    if _is_blocked(response):
+        return None
+    response.raise_for_status()
+    return _parse_entity_names(response.text)
+
+# Result-block titles used to attribute entity links in a combined SERP
+HEADING_SELECTOR = "h1, h2, h3, h4, h5, h6, [role=heading]"
+
+def _heading_texts(block) -> List[str]:
+    """Lower-cased heading texts of a result block, ignoring entity link labels."""
+    texts = []
+    for heading in block.css(HEADING_SELECTOR):
+        # Nodes are fresh wrappers on every access, so compare by identity of the DOM node
+        parent = heading.parent
+        while parent is not None and parent.mem_id != block.mem_id:
+            if parent.tag == "a" and "data-entityname" in parent.attributes:
+                break
+            parent = parent.parent
+        if parent is None or parent.mem_id != block.mem_id:
+            continue  # heading is part of an entity link's own label
+        text = heading.text(deep=True)
+        for link in heading.css("a[data-entityname]"):
+            text = text.replace(link.text(deep=True), " ")
+        texts.append(text.lower())
+    return texts
+
+def _assign_entities_to_companies(html: str, companies: List[str]) -> Dict[str, List[str]]:
+    """
+    Attribute each ``data-entityname`` link of a combined SERP to the input company
+    named in the headings of its closest enclosing result block. Entity labels never
+    count, so a company mentioned inside another company's results is not credited
+    with them. Ambiguous links are dropped.
+    """
+    lowered = [(company, company.lower().strip()) for company in companies]
+    assigned: Dict[str, List[str]] = {}
+    for node in HTMLParser(html).css("a[data-entityname]"):
+        val = (node.attributes.get("data-entityname") or "").strip()
+        if not val:
+            continue
+
+        ancestor = node.parent
+        while ancestor is not None:
+            headings = _heading_texts(ancestor)
+            matches = [company for company, key in lowered if any(key in text for text in headings)]
+            if len(matches) == 1:
+                names = assigned.setdefault(matches[0], [])
+                if val not in names:
+                    names.append(val)
+            if matches:
+                break
+            ancestor = ancestor.parent
+    return assigned
+
+async def _batched_search(companies: List[str], client: httpx.AsyncClient) -> Dict[str, List[str]]:
+    """
+    Search up to ``MAX_BATCH_SIZE`` companies with a single OR query. Only the companies
+    whose results could be attributed are returned; callers search the rest one by one.
+    """
+    url = _search_url(" OR ".join(f'("{company}" subsidiary)' for company in companies))
+
+    try:
+        response = await client.get(url)
+        if _is_blocked(response):
+            return {}
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.warning("Error batch searching for %s: %s", ", ".join(companies), e)
+        return {}
+    return _assign_entities_to_companies(response.text, companies)
+
+async def _fetch_subsidiaries(company_name: str, client: httpx.AsyncClient,
+                              fallback: BrowserFallback) -> Optional[List[str]]:
+    """
+    Search Google for subsidiaries, bypassing the cache. Uses the shared HTTP client and
+    only falls back to Playwright when Google serves a consent/captcha page instead of
+    results. Non-empty results are cached; returns None when the search failed.
+    """
+    try:
+        names = await _search_with_http(client, company_name)
+        if names is None:
+            logger.info("Interstitial returned for '%s', retrying with Playwright...", company_name)
+            async with fallback.page() as page:
+                names = await _search_with_page(page, company_name)
+    except Exception as e:
+        logger.warning("Error searching for %s: %s", company_name, e)
+        return None
+
+    # An empty list may be an unrecognised interstitial rather than a real answer,
+    # so it is never cached and the next run searches again
+    if names:
+        await cache_subsidiaries(company_name, names)
+    return names
+
+# ---------------------------------
+# Rate Limiting
+# ---------------------------------
+class TokenBucket:
+    """Async token bucket: allows bursts of ``capacity`` and ``rate`` acquisitions per second."""
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
 
 # ---------------------------------
 # Hierarchical Search
 # ---------------------------------
-def get_subsidiaries_hierarchy(company_name: str, max_depth: int = 10,
-                               delay_between_searches: float = 3.0, max_workers: int = 2) -> Dict:
+class SubsidiaryEvent(NamedTuple):
+    """One company discovered by the crawl; ``node_id``/``parent_id`` link it into the tree."""
+    company: str
+    parent: Optional[str]
+    depth: int
+    node_id: int
+    parent_id: int
+
+async def aiter_subsidiaries(company_name: str, max_depth: int = 10,
+                             qps: float = 0.5, max_workers: int = 2,
+                             cdp_endpoint: Optional[str] = CDP_ENDPOINT,
+                             batch_size: int = 1) -> AsyncIterator[SubsidiaryEvent]:
     """
-    Get hierarchical subsidiaries for a company using multithreading with Playwright.
+    Crawl the subsidiaries of a company, yielding each company as soon as it is found.
+    The hierarchy is crawled breadth-first by ``max_workers`` long-lived worker tasks
+    fed from a single queue, so a slow search never stalls the rest of the crawl.
+    Searches share one HTTP/2 client (and one Playwright browser, launched only if
+    Google blocks plain HTTP) and are rate limited to ``qps`` searches per second.
+    With ``cdp_endpoint`` set, that browser is a shared Chromium reached over CDP.
+    A ``batch_size`` above 1 lets a worker combine that many queued companies into
+    one OR query.
     """
-    print(f"Starting hierarchical subsidiary research for: {company_name}")
+    logger.info("Starting hierarchical subsidiary research for: %s", company_name)
 
-    searched_companies: Set[str] = set()
-    searched_lock = threading.Lock()
+    # Normalized name -> name as first seen. Only touched from coroutines on this loop's
+    # thread, and the check-and-set below never awaits, so it needs no lock.
+    searched_companies: Dict[str, str] = {}
+    bucket = TokenBucket(qps, capacity=max_workers)
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
 
-    hierarchy = {
-        "company": company_name,
-        "subsidiaries": {},
-        "total_companies_found": 0
-    }
+    # Node ids are assigned in discovery order starting at 1; 0 is the virtual root
+    names: List[Optional[str]] = [None]
+    pending: asyncio.Queue = asyncio.Queue()
+    discovered: asyncio.Queue = asyncio.Queue()
+    pending.put_nowait((company_name, 1, 0))
 
-    def search_single_company(company: str, current_depth: int) -> tuple:
-        with searched_lock:
-            company_lower = company.lower().strip()
-            if company_lower in searched_companies:
-                return company, [], True
-            searched_companies.add(company_lower)
+    def discover(company: str, depth: int, parent_id: int) -> int:
+        names.append(company)
+        node_id = len(names) - 1
+        discovered.put_nowait(SubsidiaryEvent(company, names[parent_id], depth, node_id, parent_id))
+        return node_id
 
-        print(f"Level {current_depth}: Searching for subsidiaries of '{company}'...")
-        time.sleep(delay_between_searches)
+    async def search_companies(client, fallback, batch: List[tuple]) -> List[tuple]:
+        """Search a batch of queued items; returns (item, subsidiaries) for the ones not yet searched."""
+        claimed = []
+        for item in batch:
+            key = _normalize(item[0])
+            if key not in searched_companies:
+                searched_companies[key] = item[0]
+                claimed.append(item)
 
-        subsidiaries = get_subsidiaries_single_search(company)
-        return company, subsidiaries, False
+        # Deduped nodes and cache hits never consume rate-limit tokens
+        results: Dict[str, List[str]] = {}
+        misses = []
+        for company, current_depth, _ in claimed:
+            subsidiaries = await get_cached_subsidiaries(company)
+            if subsidiaries is not None:
+                logger.info("Level %d: Using cached subsidiaries of '%s'", current_depth, company)
+                results[company] = subsidiaries
+            else:
+                misses.append((company, current_depth))
 
-    def search_level(companies_to_search: List[str], current_depth: int) -> Dict:
-        if current_depth > max_depth or not companies_to_search:
-            return {}
+        if len(misses) > 1:
+            await bucket.acquire()
+            logger.info("Level %d: Batch searching for subsidiaries of %s...", misses[0][1],
+                        ", ".join(repr(company) for company, _ in misses))
+            # Batched attribution is heuristic and partial, so it is never written to the
+            # shared cache where exact single-company lookups would pick it up
+            results.update(await _batched_search([c for c, _ in misses], client))
+            misses = [miss for miss in misses if miss[0] not in results]
 
-        level_results = {}
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_company = {
-                executor.submit(search_single_company, company, current_depth): company
-                for company in companies_to_search
-            }
-            for future in as_completed(future_to_company):
-                try:
-                    company, subsidiaries, already_searched = future.result()
-                    if already_searched:
-                        continue
+        for company, current_depth in misses:
+            await bucket.acquire()
+            logger.info("Level %d: Searching for subsidiaries of '%s'...", current_depth, company)
+            results[company] = await _fetch_subsidiaries(company, client, fallback) or []
 
-                    level_results[company] = {"subsidiaries": {}}
-                    if subsidiaries:
+        return [(item, results[item[0]]) for item in claimed]
+
+    async def worker(client, fallback):
+        while True:
+            batch = [await pending.get()]
+            while len(batch) < batch_size and not pending.empty():
+                batch.append(pending.get_nowait())
+            try:
+                for (company, current_depth, parent_id), subsidiaries in await search_companies(
+                    client, fallback, batch
+                ):
+                    node_id = discover(company, current_depth, parent_id)
+                    for sub in subsidiaries:
                         if current_depth < max_depth:
-                            next_level_results = search_level(subsidiaries, current_depth + 1)
-                            level_results[company]["subsidiaries"] = next_level_results
+                            pending.put_nowait((sub, current_depth + 1, node_id))
                         else:
-                            for sub in subsidiaries:
-                                level_results[company]["subsidiaries"][sub] = {"subsidiaries": {}}
-                except Exception as e:
-                    print(f"Error searching for company: {e}")
-        return level_results
+                            discover(sub, current_depth + 1, node_id)
+            except Exception as e:
+                logger.warning("Error searching for company: %s", e)
+            finally:
+                for _ in batch:
+                    pending.task_done()
 
-    hierarchy["subsidiaries"] = search_level([company_name], 1)
+    async def crawl():
+        fallback = BrowserFallback(cdp_endpoint, size=max_workers)
+        try:
+            async with create_http_client(max_workers) as client:
+                workers = [asyncio.create_task(worker(client, fallback)) for _ in range(max_workers)]
+                try:
+                    await pending.join()
+                finally:
+                    for w in workers:
+                        w.cancel()
+                    await asyncio.gather(*workers, return_exceptions=True)
+        finally:
+            await fallback.close()
+            discovered.put_nowait(None)
 
-    def count_companies(node):
-        count = 1
-        for _, data in node.get("subsidiaries", {}).items():
-            count += count_companies(data)
-        return count
+    crawl_task = asyncio.create_task(crawl())
+    try:
+        while True:
+            event = await discovered.get()
+            if event is None:
+                break
+            yield event
+        await crawl_task
+    finally:
+        if not crawl_task.done():
+            crawl_task.cancel()
+            await asyncio.gather(crawl_task, return_exceptions=True)
 
-    if hierarchy["subsidiaries"]:
-        hierarchy["total_companies_found"] = (
-            count_companies({"subsidiaries": hierarchy["subsidiaries"]}) - 1
-        )
+def iter_subsidiaries(company_name: str, *args, run_id: Optional[str] = None,
+                      **kwargs) -> Iterator[SubsidiaryEvent]:
+    """
+    Synchronous version of ``aiter_subsidiaries``: the crawl runs on its own event loop
+    in a background thread and discovered companies are handed over through a queue.
+    Log records emitted by the crawl carry ``run_id`` as ``record.run_id``.
+    """
+    events: queue.Queue = queue.Queue()
+    stop = threading.Event()
+    done = object()
+
+    async def consume():
+        async for event in aiter_subsidiaries(company_name, *args, **kwargs):
+            events.put(event)
+            if stop.is_set():
+                break
+
+    def run():
+        _run_id.set(run_id)
+        try:
+            run_async(consume())
+        except BaseException as e:
+            events.put(e)
+        finally:
+            events.put(done)
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            event = events.get()
+            if event is done:
+                break
+            if isinstance(event, BaseException):
+                raise event
+            yield event
+    finally:
+        stop.set()
+
+def build_hierarchy(company_name: str, events: Iterable[SubsidiaryEvent]) -> Dict:
+    """Assemble the nested hierarchy dict from crawl events."""
+    hierarchy = {
+        "company": company_name,
+        "subsidiaries": {},
+        "total_companies_found": 0
+    }
+
+    # Parents are always discovered before their children, so one forward pass builds the tree
+    node_dicts = {0: hierarchy}
+    for event in events:
+        node = {"subsidiaries": {}}
+        node_dicts[event.parent_id]["subsidiaries"][event.company] = node
+        node_dicts[event.node_id] = node
+    hierarchy["total_companies_found"] = len(node_dicts) - 1
     return hierarchy
 
+async def get_subsidiaries_hierarchy(company_name: str, max_depth: int = 10,
+                                     qps: float = 0.5, max_workers: int = 2,
+                                     cdp_endpoint: Optional[str] = CDP_ENDPOINT,
+                                     batch_size: int = 1) -> Dict:
+    """
+    Get hierarchical subsidiaries for a company once the whole crawl has finished.
+    See ``aiter_subsidiaries`` for the parameters. Call with ``run_async(...)`` from sync code.
+    """
+    events = [event async for event in aiter_subsidiaries(
+        company_name, max_depth, qps, max_workers, cdp_endpoint, batch_size
+    )]
+    return build_hierarchy(company_name, events)
+
 # ---------------------------------
 # Utilities
 # ---------------------------------
@@ -161,6 +830,8 @@ def save_hierarchy_to_file(hierarchy: Dict, filename: str = None):
 
 if __name__ == "__main__":
     company = input("Enter Company Name: ").strip()
-    hierarchy = get_subsidiaries_hierarchy(company, max_depth=3, delay_between_searches=2, max_workers=2)
+    hierarchy = run_async(
+        get_subsidiaries_hierarchy(company, max_depth=3, qps=1.0, max_workers=2)
+    )
     print_hierarchy(hierarchy)
     save_hierarchy_to_file(hierarchy)
@@ -2,10 +2,19 @@ import streamlit as st
 import pandas as pd
 import time
 import json
+import uuid
+import logging
+from collections import deque
 from datetime import datetime
 from typing import Dict, List
 from company_subsidiaries import (
-    get_subsidiaries_hierarchy,
+    iter_subsidiaries,
+    build_hierarchy,
+    logger,
+    run_async,
+    start_shared_chromium,
+    cdp_endpoint_alive,
+    CDP_ENDPOINT,
     print_hierarchy,
     save_hierarchy_to_file
 )
@@ -18,19 +27,67 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-def format_hierarchy_for_display(hierarchy: Dict, level: int = 0) -> List[Dict]:
-    display_data = []
-    for company, data in hierarchy.get("subsidiaries", {}).items():
-        display_data.append({
-            "Company": company,
-            "Level": level,
-            "Indent": "  " * level + "├── " if level > 0 else "",
-            "Has_Subsidiaries": len(data.get("subsidiaries", {})) > 0
-        })
-        if data.get("subsidiaries"):
-            child_data = format_hierarchy_for_display(data, level + 1)
-            display_data.extend(child_data)
-    return display_data
+@st.cache_resource
+def shared_chromium_endpoint():
+    """Boot one Chromium per server process; every session connects to it over CDP."""
+    if CDP_ENDPOINT:
+        return CDP_ENDPOINT
+    try:
+        return run_async(start_shared_chromium())
+    except Exception as e:
+        logger.warning("Shared Chromium unavailable, sessions will launch their own: %s", e)
+        return None
+
+def current_chromium_endpoint():
+    """Return the shared Chromium endpoint, rebooting it if the cached one stopped answering."""
+    endpoint = shared_chromium_endpoint()
+    if endpoint and endpoint != CDP_ENDPOINT and not cdp_endpoint_alive(endpoint):
+        shared_chromium_endpoint.clear()
+        endpoint = shared_chromium_endpoint()
+    return endpoint
+
+class LogBufferHandler(logging.Handler):
+    """Collect one run's crawler log lines into a bounded deque for the log pane."""
+
+    def __init__(self, buffer: deque, run_id: str):
+        super().__init__()
+        self.buffer = buffer
+        self.run_id = run_id
+
+    def emit(self, record):
+        # The crawler logger is shared by every session in the process
+        if getattr(record, "run_id", None) == self.run_id:
+            self.buffer.append(self.format(record))
+
+INDENTS = ["  " * i for i in range(12)]  # max depth slider (10) + leaves + root
+
+def _indent(level: int) -> str:
+    """Look up the indentation for ``level``, extending the precomputed table as needed."""
+    while level >= len(INDENTS):
+        INDENTS.append("  " * len(INDENTS))
+    return INDENTS[level]
+
+def format_hierarchy_for_display(hierarchy: Dict, level: int = 0) -> pd.DataFrame:
+    """Flatten the hierarchy into a columnar DataFrame (one list per column, not a dict per row)."""
+    companies: List[str] = []
+    levels: List[int] = []
+    has_subs: List[bool] = []
+    stack = [(company, data, level) for company, data in reversed(hierarchy.get("subsidiaries", {}).items())]
+    while stack:
+        company, data, lvl = stack.pop()
+        children = data.get("subsidiaries", {})
+        companies.append(company)
+        levels.append(lvl)
+        has_subs.append(len(children) > 0)
+        stack.extend((child, info, lvl + 1) for child, info in reversed(children.items()))
+
+    df = pd.DataFrame({"Company": companies, "Level": levels, "Has_Subsidiaries": has_subs})
+    if df.empty:
+        df.insert(2, "Indent", pd.Series(dtype=object))
+        return df
+    indent = pd.Series("  ", index=df.index, dtype=object).str.repeat(df["Level"]) + "├── "
+    df.insert(2, "Indent", indent.where(df["Level"] > 0, ""))
+    return df
 
 def create_download_content(hierarchy: Dict) -> str:
     content = []
@@ -38,26 +95,50 @@ def create_download_content(hierarchy: Dict) -> str:
     content.append(f"Total companies found: {hierarchy['total_companies_found']}")
     content.append(f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     content.append("="*60)
-    def add_level(data, indent=0):
-        prefix = "  " * indent
-        for company, info in data.get("subsidiaries", {}).items():
-            content.append(f"{prefix}├── {company}")
-            if info.get("subsidiaries"):
-                add_level(info, indent + 1)
-    add_level(hierarchy)
+    stack = [(company, info, 0) for company, info in reversed(hierarchy.get("subsidiaries", {}).items())]
+    while stack:
+        company, info, indent = stack.pop()
+        content.append(f"{_indent(indent)}├── {company}")
+        stack.extend((child, data, indent + 1) for child, data in reversed(info.get("subsidiaries", {}).items()))
     return "\n".join(content)
 
 def main():
     st.title("🏢 Company Subsidiary Research Tool")
     company_name = st.text_input("Enter Company Name", placeholder="e.g., Microsoft Corporation")
     max_depth = st.slider("Max Depth", 1, 10, 3)
-    delay = st.slider("Delay Between Searches (s)", 1, 10, 3)
+    qps = st.slider("Searches Per Second", 0.1, 5.0, 0.5, step=0.1)
     max_workers = st.slider("Max Workers", 1, 5, 2)
+    batch_size = st.slider("Companies Per Query", 1, 8, 1)
 
     if st.button("🔍 Start Search"):
         with st.spinner("Searching..."):
             start = time.time()
-            hierarchy = get_subsidiaries_hierarchy(company_name, max_depth, delay, max_workers)
+            placeholder = st.empty()
+            log_pane = st.empty()
+            log_lines = deque(maxlen=200)
+            run_id = uuid.uuid4().hex
+            log_handler = LogBufferHandler(log_lines, run_id)
+            logger.addHandler(log_handler)
+            events = []
+            table = None
+            try:
+                for event in iter_subsidiaries(company_name, max_depth, qps, max_workers,
+                                               cdp_endpoint=current_chromium_endpoint(),
+                                               batch_size=batch_size, run_id=run_id):
+                    # Append only the new row; re-sending the whole table per event is O(n^2)
+                    row = pd.DataFrame({"Company": [event.company], "Parent": [event.parent or ""],
+                                        "Level": [event.depth]}, index=[len(events)])
+                    events.append(event)
+                    if table is None:
+                        table = placeholder.dataframe(row, use_container_width=True)
+                    else:
+                        table.add_rows(row)
+                    log_pane.code("\n".join(log_lines))
+            finally:
+                logger.removeHandler(log_handler)
+            log_pane.code("\n".join(log_lines))
+            hierarchy = build_hierarchy(company_name, events)
+            placeholder.dataframe(format_hierarchy_for_display(hierarchy), use_container_width=True)
             elapsed = time.time() - start
 
             st.success(f"Search completed in {elapsed:.1f}s, found {hierarchy['total_companies_found']} companies")
@@ -0,0 +1,48 @@
+import pytest
+
+pytest.importorskip("selectolax")
+pytest.importorskip("httpx")
+pytest.importorskip("playwright")
+
+from company_subsidiaries import _assign_entities_to_companies
+
+
+def test_entities_are_credited_to_the_block_heading_not_their_labels():
+    # "Google" appears inside Alphabet's entity labels; those must not count
+    html = """
+    <div id="search">
+      <div class="g"><h3>Alphabet Inc.</h3>
+        <div class="carousel">
+          <a data-entityname="Google LLC" href="#">Google LLC</a>
+          <a data-entityname="Waymo" href="#">Waymo</a>
+        </div>
+      </div>
+      <div class="g"><h3>Google subsidiaries</h3>
+        <div><a data-entityname="YouTube" href="#">YouTube</a></div>
+      </div>
+    </div>
+    """
+    assert _assign_entities_to_companies(html, ["Alphabet", "Google"]) == {
+        "Alphabet": ["Google LLC", "Waymo"],
+        "Google": ["YouTube"],
+    }
+
+
+def test_links_under_a_heading_naming_several_inputs_are_dropped():
+    html = """
+    <div class="g"><h3>Alphabet and Google</h3>
+      <a data-entityname="Waymo" href="#">Waymo</a>
+    </div>
+    """
+    assert _assign_entities_to_companies(html, ["Alphabet", "Google"]) == {}
+
+
+def test_headings_that_are_entity_labels_are_ignored():
+    html = """
+    <div class="g"><h3>Alphabet Inc.</h3>
+      <a data-entityname="Google LLC" href="#"><h3>Google LLC</h3></a>
+    </div>
+    """
+    assert _assign_entities_to_companies(html, ["Alphabet", "Google"]) == {
+        "Alphabet": ["Google LLC"],
+    }